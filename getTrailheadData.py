@@ -1,17 +1,47 @@
 import os
 import sys
-import requests
+import hashlib
+import time
+import httpx
+import orjson
 import mysql.connector
-from datetime import datetime, date
-from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, List, Tuple
 
 GRAPHQL_URL = "https://profile.api.trailhead.com/graphql"
 
-GRAPHQL_QUERY = """
+# Concurrent Trailhead requests; multiplexed as HTTP/2 streams over CLIENT's connections.
+FETCH_WORKERS = 16
+
+# Throttling/5xx responses are retried after the server's Retry-After, if sent,
+# else with exponential backoff (0.3s, 0.6s, 1.2s); never waits over MAX_RETRY_DELAY s.
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 60.0
+
+# Profiles per aliased GraphQL document (one HTTP round-trip per chunk).
+GRAPHQL_BATCH_SIZE = 25
+
+# Fetched users buffered before each sync_users_to_db() call while fetches continue.
+SYNC_BATCH_SIZE = 500
+
+# Rows per executemany() call; bounds the multi-row INSERT under max_allowed_packet.
+DB_BATCH_SIZE = 5000
+
+
+def minify_graphql(query: str) -> str:
+    # Collapse all whitespace; safe because the documents contain no string literals.
+    return " ".join(query.split())
+
+
+# Only the fields read by normalize_certifications(). __typename keeps a private profile
+# a non-empty object, so it syncs as a user with zero certs rather than as "not found".
+GRAPHQL_QUERY = minify_graphql("""
 query GetUserCertifications($slug: String, $hasSlug: Boolean!) {
   profile(slug: $slug) @include(if: $hasSlug) {
     __typename
-    id
     ... on PublicProfile {
       credential {
         certifications {
@@ -19,17 +49,39 @@ query GetUserCertifications($slug: String, $hasSlug: Boolean!) {
           dateCompleted
           dateExpired
           product
-          status {
-            title
-            expired
-            date
-          }
         }
       }
     }
   }
 }
-"""
+""")
+
+GRAPHQL_CERT_FRAGMENT = minify_graphql("""
+fragment CertFields on PublicProfile {
+  credential {
+    certifications {
+      title
+      dateCompleted
+      dateExpired
+      product
+    }
+  }
+}
+""")
+
+# One HTTP/2 client for the whole run, shared by the fetch threads: concurrent GraphQL
+# calls multiplex over a few TLS connections instead of one socket each.
+# Bodies are encoded/decoded with orjson, hence the explicit Content-Type.
+# Compressed responses are decoded transparently by httpx.
+CLIENT = httpx.Client(
+    headers={"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"},
+    timeout=30,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=MAX_RETRIES,  # connection failures only
+        limits=httpx.Limits(max_connections=10),
+    ),
+)
 
 
 # -----------------------------
@@ -45,11 +97,17 @@ def parse_iso_date(d: Optional[str]) -> Optional[date]:
     if not d:
         return None
     try:
-        return datetime.strptime(d[:10], "%Y-%m-%d").date()
-    except Exception:
+        return date.fromisoformat(d[:10])
+    except (TypeError, ValueError):
         return None
 
 
+def certs_hash(certs: List[Dict[str, Any]]) -> str:
+    # Order-independent fingerprint of a user's normalized certifications.
+    ordered = sorted(certs, key=lambda c: (c["title"], c["product"] or "", c["dateCompleted"]))
+    return hashlib.sha256(orjson.dumps(ordered, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
 # -----------------------------
 # DB
 # -----------------------------
@@ -63,6 +121,10 @@ def get_db_connection():
         password=os.environ["DB_PASS"],
         database=os.environ["DB_NAME"],
         connection_timeout=20,
+        # The whole sync runs as one transaction, committed once at the end of main().
+        autocommit=False,
+        # use_pure is deliberately left unset: the default already uses the C extension
+        # when it loads, while use_pure=False turns an unloadable one into ImportError.
     )
 
     # TLS / SSL (optional)
@@ -78,7 +140,7 @@ def load_profiles_from_db(conn) -> List[str]:
     sql = "SELECT username FROM trailhead_user WHERE active = 1"
     with conn.cursor() as cur:
         cur.execute(sql)
-        return [row[0] for row in cur.fetchall()]
+        return [row[0] for row in cur]
 
 
 def set_session_limits(conn) -> None:
@@ -87,48 +149,93 @@ def set_session_limits(conn) -> None:
         cur.execute("SET SESSION group_concat_max_len = 100000")
 
 
-def upsert_user(conn, name: str, username: str) -> int:
+def load_users(conn) -> Dict[str, Tuple[int, Optional[str]]]:
     """
+    username -> (id, last_hash).
+    last_hash needs migrations/001_trailhead_user_last_hash.sql applied.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, username, last_hash FROM trailhead_user")
+        return {username: (user_id, last_hash) for user_id, username, last_hash in cur}
+
+
+def load_cert_ids(conn) -> Dict[Tuple[str, Optional[str]], int]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, title, product FROM trailhead_cert")
+        return {(title, product): cert_id for cert_id, title, product in cur}
+
+
+def upsert_users(conn, users: List[Tuple[str, str]]) -> None:
+    """
+    Upsert (username, last_hash) rows; see migrations/001_trailhead_user_last_hash.sql.
     Do NOT overwrite existing 'name' if it already exists.
     Fill it only when NULL or empty string.
     """
     sql = """
-    INSERT INTO trailhead_user (name, username)
-    VALUES (%s, %s)
+    INSERT INTO trailhead_user (name, username, last_hash)
+    VALUES (%s, %s, %s)
     ON DUPLICATE KEY UPDATE
       name = CASE
         WHEN trailhead_user.name IS NULL OR trailhead_user.name = '' THEN VALUES(name)
         ELSE trailhead_user.name
       END,
+      last_hash = VALUES(last_hash),
       updated_at = CURRENT_TIMESTAMP
     """
+    # If you later fetch a real display name, replace name=username with that value.
+    rows = [(username, username, last_hash) for username, last_hash in users]
     with conn.cursor() as cur:
-        cur.execute(sql, (name, username))
-        cur.execute("SELECT id FROM trailhead_user WHERE username=%s", (username,))
-        return cur.fetchone()[0]
+        for i in range(0, len(rows), DB_BATCH_SIZE):
+            cur.executemany(sql, rows[i:i + DB_BATCH_SIZE])
 
 
 def upsert_cert(conn, title: str, product: Optional[str]) -> int:
+    """
+    Relies on the UNIQUE KEY (title, product); returns the id via LAST_INSERT_ID(id).
+    """
     sql = """
     INSERT INTO trailhead_cert (title, product)
     VALUES (%s, %s)
     ON DUPLICATE KEY UPDATE
+      id = LAST_INSERT_ID(id),
       title = VALUES(title),
       product = VALUES(product)
     """
     with conn.cursor() as cur:
         cur.execute(sql, (title, product))
-        cur.execute(
-            "SELECT id FROM trailhead_cert WHERE title=%s AND (product <=> %s)",
-            (title, product),
-        )
-        return cur.fetchone()[0]
+        return cur.lastrowid
 
 
-def upsert_user_cert(conn, user_id: int, cert_id: int, date_completed: date, date_expired: Optional[date]) -> None:
+def upsert_certs(conn, certs: List[Tuple[str, Optional[str]]]) -> None:
     """
-    Upsert the relation. Only bump updated_at when date_expired actually changes.
-    (If you don't care about updated_at churn, you can simplify this back.)
+    Batch form of upsert_cert(); ids are read back afterwards with load_cert_ids().
+    """
+    sql = """
+    INSERT INTO trailhead_cert (title, product)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE
+      title = VALUES(title),
+      product = VALUES(product)
+    """
+    with conn.cursor() as cur:
+        for i in range(0, len(certs), DB_BATCH_SIZE):
+            cur.executemany(sql, certs[i:i + DB_BATCH_SIZE])
+
+
+def get_cert_id(conn, cert_ids: Dict[Tuple[str, Optional[str]], int], title: str, product: Optional[str]) -> int:
+    key = (title, product)
+    cert_id = cert_ids.get(key)
+    if cert_id is None:
+        # Not matched after the batch insert (e.g. collation differences): upsert singly.
+        cert_id = cert_ids[key] = upsert_cert(conn, title, product)
+    return cert_id
+
+
+def upsert_user_certs(conn, rows: List[Tuple[int, int, date, Optional[date]]]) -> None:
+    """
+    Batch upsert of (user_id, cert_id, date_completed, date_expired) rows.
+    Only bump updated_at when date_expired actually changes.
+    executemany() rewrites each chunk into a single multi-row INSERT.
     """
     sql = """
     INSERT INTO trailhead_user_cert (user_id, cert_id, date_completed, date_expired)
@@ -137,15 +244,83 @@ def upsert_user_cert(conn, user_id: int, cert_id: int, date_completed: date, dat
       date_expired = VALUES(date_expired),
       updated_at = IF(VALUES(date_expired) <=> date_expired, updated_at, CURRENT_TIMESTAMP)
     """
+    # Deliberately not cursor(prepared=True): a prepared cursor runs executemany() as one
+    # COM_STMT_EXECUTE per row and loses the multi-row INSERT rewrite.
+    # Deliberately not INSERT ... SELECT over a derived table joined on username either:
+    # literal rows take the connection collation (error 1267 against the column's), and
+    # rows that miss the JOIN vanish silently after last_hash was already written.
     with conn.cursor() as cur:
-        cur.execute(sql, (user_id, cert_id, date_completed, date_expired))
+        for i in range(0, len(rows), DB_BATCH_SIZE):
+            cur.executemany(sql, rows[i:i + DB_BATCH_SIZE])
 
 
 # -----------------------------
 # Trailhead fetch
 # -----------------------------
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    # Retry-After is either delta-seconds or an HTTP-date (RFC 9110 10.2.3).
+    delay = 0.3 * 2 ** attempt
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    # Clamp: a hostile or buggy Retry-After must not stall a worker for hours.
+    return min(max(0.0, delay), MAX_RETRY_DELAY)
+
+
+def post_graphql(payload: Dict[str, Any]) -> httpx.Response:
+    # The query is read-only, so retrying the POST on throttling/5xx is safe.
+    response = CLIENT.post(GRAPHQL_URL, content=orjson.dumps(payload))
+    for attempt in range(MAX_RETRIES):
+        if response.status_code not in RETRY_STATUSES:
+            break
+        time.sleep(retry_delay(response, attempt))
+        response = CLIENT.post(GRAPHQL_URL, content=orjson.dumps(payload))
+    return response
+
+
+def normalize_certifications(username: str, profile: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if profile is None:
+        return {"Username": username, "Error": "No public profile found"}
+
+    credential = profile.get("credential") or {}
+    certifications = credential.get("certifications") or []
+
+    # Hot loop on large profiles: bind norm.append and parse_iso_date to locals once.
+    norm: List[Dict[str, Any]] = []
+    append = norm.append
+    parse = parse_iso_date
+    for c in certifications:
+        dc_raw = c.get("dateCompleted")
+        if not dc_raw:
+            continue
+
+        title = (c.get("title") or "").strip()
+        if not title:
+            continue
+
+        dc = parse(dc_raw)
+        if not dc:
+            continue
+
+        append(
+            {
+                "title": title,
+                "product": c.get("product"),
+                "dateCompleted": dc,
+                "dateExpired": parse(c.get("dateExpired")),
+            }
+        )
+
+    return {"Username": username, "CertificationsRaw": norm}
+
+
 def fetch_certifications(username: str) -> Dict[str, Any]:
-    headers = {"Content-Type": "application/json"}
     payload = {
         "operationName": "GetUserCertifications",
         "variables": {"hasSlug": True, "slug": username},
@@ -153,7 +328,7 @@ def fetch_certifications(username: str) -> Dict[str, Any]:
     }
 
     try:
-        response = requests.post(GRAPHQL_URL, json=payload, headers=headers, timeout=30)
+        response = post_graphql(payload)
     except Exception as e:
         return {"Username": username, "Error": f"Request failed: {e}"}
 
@@ -161,49 +336,110 @@ def fetch_certifications(username: str) -> Dict[str, Any]:
         return {"Username": username, "Error": f"HTTP {response.status_code}"}
 
     try:
-        data = response.json()
+        data = orjson.loads(response.content)
     except Exception as e:
         return {"Username": username, "Error": f"Invalid JSON: {e}"}
 
-    profile = (data.get("data") or {}).get("profile")
-    if not profile:
-        return {"Username": username, "Error": "No public profile found"}
+    return normalize_certifications(username, (data.get("data") or {}).get("profile"))
 
-    credential = profile.get("credential") or {}
-    certifications = credential.get("certifications") or []
 
-    norm: List[Dict[str, Any]] = []
-    for c in certifications:
-        title = (c.get("title") or "").strip()
-        if not title:
-            continue
+def build_batch_query(n: int) -> str:
+    params = ",".join(f"$s{i}:String" for i in range(n))
+    # __typename as in GRAPHQL_QUERY: private profiles must not come back as {}.
+    fields = " ".join(f"p{i}:profile(slug:$s{i}){{__typename ...CertFields}}" for i in range(n))
+    return f"query GetUserCertificationsBatch({params}){{{fields}}} {GRAPHQL_CERT_FRAGMENT}"
 
-        dc = parse_iso_date(c.get("dateCompleted"))
-        if not dc:
-            continue
 
-        de = parse_iso_date(c.get("dateExpired"))
-        product = c.get("product")
+def fetch_certifications_batch(usernames: List[str]) -> List[Dict[str, Any]]:
+    """
+    Fetch several profiles in one aliased GraphQL document (p0, p1, ...).
+    Falls back to per-user requests only for GraphQL-level failures (whole document
+    rejected, or errors on single aliases). Transport errors, throttling and 5xx after
+    retries fail the whole chunk: re-sending it as 25 requests would only add load.
+    """
+    if len(usernames) == 1:
+        return [fetch_certifications(usernames[0])]
 
-        norm.append(
-            {
-                "title": title,
-                "product": product,
-                "dateCompleted": dc,
-                "dateExpired": de,
-            }
-        )
+    payload = {
+        "operationName": "GetUserCertificationsBatch",
+        "variables": {f"s{i}": u for i, u in enumerate(usernames)},
+        "query": build_batch_query(len(usernames)),
+    }
 
-    return {"Username": username, "CertificationsRaw": norm}
+    try:
+        response = post_graphql(payload)
+    except Exception as e:
+        return [{"Username": u, "Error": f"Request failed: {e}"} for u in usernames]
 
+    if response.status_code == 429 or response.status_code >= 500:
+        return [{"Username": u, "Error": f"HTTP {response.status_code}"} for u in usernames]
 
-def sync_user_to_db(conn, username: str, certs_raw: List[Dict[str, Any]]) -> None:
-    # If you later fetch a real display name, replace name=username with that value.
-    user_id = upsert_user(conn, name=username, username=username)
+    try:
+        data = orjson.loads(response.content)
+    except Exception:
+        return [fetch_certifications(u) for u in usernames]
+
+    profiles = data.get("data")
+    if not profiles:
+        return [fetch_certifications(u) for u in usernames]
+
+    failed = {str(e["path"][0]) for e in data.get("errors") or [] if e.get("path")}
+
+    results: List[Dict[str, Any]] = []
+    for i, username in enumerate(usernames):
+        alias = f"p{i}"
+        if alias in failed or alias not in profiles:
+            results.append(fetch_certifications(username))
+        else:
+            results.append(normalize_certifications(username, profiles[alias]))
+    return results
+
+
+def sync_users_to_db(
+    conn,
+    results: List[Dict[str, Any]],
+    users: Dict[str, Tuple[int, Optional[str]]],
+    cert_ids: Dict[Tuple[str, Optional[str]], int],
+) -> int:
+    """
+    Write users whose certifications changed since the last run; returns how many.
+    Unchanged users (same certs_hash as trailhead_user.last_hash) are skipped entirely.
+    `users` is the load_users() map; it is refreshed if a synced user was not in it yet.
+    `cert_ids` is the run's (title, product) -> id cache, shared across calls so each
+    distinct certification hits the DB at most once; it is filled lazily.
+    """
+    changed: List[Tuple[Dict[str, Any], str]] = []
+    for r in results:
+        h = certs_hash(r["CertificationsRaw"])
+        if users.get(r["Username"], (None, None))[1] != h:
+            changed.append((r, h))
 
-    for c in certs_raw:
-        cert_id = upsert_cert(conn, c["title"], c.get("product"))
-        upsert_user_cert(conn, user_id, cert_id, c["dateCompleted"], c.get("dateExpired"))
+    if not changed:
+        return 0
+
+    upsert_users(conn, [(r["Username"], h) for r, h in changed])
+    if any(r["Username"] not in users for r, _ in changed):
+        users.update(load_users(conn))
+    if not cert_ids:
+        cert_ids.update(load_cert_ids(conn))
+
+    seen = {(c["title"], c.get("product")) for r, _ in changed for c in r["CertificationsRaw"]}
+    new_certs = seen - cert_ids.keys()
+    if new_certs:
+        upsert_certs(conn, list(new_certs))
+        cert_ids.update(load_cert_ids(conn))
+
+    rows: List[Tuple[int, int, date, Optional[date]]] = []
+
+    for r, _ in changed:
+        user_id = users[r["Username"]][0]
+
+        for c in r["CertificationsRaw"]:
+            cert_id = get_cert_id(conn, cert_ids, c["title"], c.get("product"))
+            rows.append((user_id, cert_id, c["dateCompleted"], c.get("dateExpired")))
+
+    upsert_user_certs(conn, rows)
+    return len(changed)
 
 
 # -----------------------------
@@ -219,29 +455,60 @@ def main() -> int:
             print("No active profiles found in DB.")
             return 0
 
+        users = load_users(conn)
+        # Lives only as long as this run's transaction, so a rollback can't leave stale ids behind.
+        cert_ids: Dict[Tuple[str, Optional[str]], int] = {}
+        chunks = [profiles[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(profiles), GRAPHQL_BATCH_SIZE)]
+
         ok = 0
         errors = 0
-
-        for username in profiles:
-            r = fetch_certifications(username)
-            if r.get("Error"):
-                errors += 1
-                print(f"⚠️ {username}: {r['Error']}")
-                continue
-
-            sync_user_to_db(conn, username, r["CertificationsRaw"])
-            ok += 1
+        changed = 0
+        pending: List[Dict[str, Any]] = []
+
+        # Fetch on the worker threads; this thread is the only DB writer and syncs every
+        # SYNC_BATCH_SIZE results as they arrive, overlapping MySQL with the remaining fetches.
+        pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        try:
+            futures = [pool.submit(fetch_certifications_batch, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                for r in future.result():
+                    if r.get("Error"):
+                        errors += 1
+                        print(f"⚠️ {r['Username']}: {r['Error']}")
+                        continue
+
+                    pending.append(r)
+
+                if len(pending) >= SYNC_BATCH_SIZE:
+                    changed += sync_users_to_db(conn, pending, users, cert_ids)
+                    ok += len(pending)
+                    pending = []
+        except BaseException:
+            # Don't hold the transaction open waiting on fetches nobody will use:
+            # drop queued chunks and go straight to the rollback below.
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+
+        changed += sync_users_to_db(conn, pending, users, cert_ids)
+        ok += len(pending)
 
         conn.commit()
-        print(f"✅ MySQL synced for {ok} users")
+        print(f"✅ MySQL synced for {ok} users ({changed} changed)")
 
         if errors:
             print(f"⚠️ Completed with {errors} errors (see logs above)")
 
         return 0
 
+    except Exception:
+        # All-or-nothing: never leave a partially synced run behind.
+        conn.rollback()
+        raise
+
     finally:
         conn.close()
+        CLIENT.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+-- Required by getTrailheadData.py (load_users / upsert_users) before deploying the
+-- unchanged-user skip: stores certs_hash() of each user's certifications from the last run.
+-- NULL means "never synced with a hash", so every user is written once on the first run.
+ALTER TABLE trailhead_user
+  ADD COLUMN last_hash CHAR(64) NULL;